@@ -1,11 +1,21 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
+import plotly.io as pio
 from msal import ConfidentialClientApplication
 import requests
 import io
+import os
+import shutil
+import time
+import hashlib
+import threading
 import openpyxl
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet
 
 # streamlit run home.py
 # pip freeze > requirements.txt
@@ -33,13 +43,267 @@ def obter_token_acesso(app):
     return token_response.get('access_token', '')
 
 
-def download_file_from_sharepoint(headers, file_id, site_id, drive_id):
-    url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives/{drive_id}/items/{file_id}/content"
+def download_file_from_sharepoint(headers, file_id, site_id, drive_id, graph_url='https://graph.microsoft.com/v1.0'):
+    url = f"{graph_url}/sites/{site_id}/drives/{drive_id}/items/{file_id}/content"
     response = requests.get(url, headers=headers)
     response.raise_for_status()
     return io.BytesIO(response.content)
 
 
+def obter_versao_arquivo(headers, file_id, site_id, drive_id, graph_url='https://graph.microsoft.com/v1.0'):
+    # Consulta apenas os metadados do arquivo (eTag muda a cada alteração da planilha)
+    url = f"{graph_url}/sites/{site_id}/drives/{drive_id}/items/{file_id}?$select=eTag"
+    response = requests.get(url, headers=headers)
+    response.raise_for_status()
+    return response.json().get('eTag', '')
+
+
+# ====================================================================
+# FUNÇÕES PARTIÇÕES DAS PLANILHAS
+# ====================================================================
+
+def obter_particoes_horas(config_sharepoint):
+    # Lista de planilhas de horas (ex.: uma por ano) ou a planilha única de horas
+    particoes = config_sharepoint.get('particoes_horas')
+    if not particoes:
+        return [{'id': config_sharepoint['planilha_horas_id'], 'planilha': 'horas_resolv',
+                 'inicio': None, 'fim': None, 'fechada': False}]
+    return [{
+        'id': particao['id'],
+        'planilha': particao.get('planilha', 'horas_resolv'),
+        'inicio': pd.Timestamp(particao['inicio']) if particao.get('inicio') else None,
+        'fim': pd.Timestamp(particao['fim']) if particao.get('fim') else None,
+        'fechada': particao.get('fechada', False)
+    } for particao in particoes]
+
+
+def podar_particoes(particoes, intervalo):
+    # Mantém apenas as partições que têm datas dentro do intervalo selecionado
+    if not intervalo:
+        return particoes
+    inicio, fim = pd.Timestamp(intervalo[0]), pd.Timestamp(intervalo[1])
+    selecionadas = [particao for particao in particoes
+                    if (particao['inicio'] is None or particao['inicio'] <= fim) and
+                    (particao['fim'] is None or particao['fim'] >= inicio)]
+    return selecionadas or particoes
+
+
+def limites_particoes(particoes):
+    # Intervalo total declarado nas partições, ou None se alguma não tiver data de início
+    if any(particao['inicio'] is None for particao in particoes):
+        return None
+    hoje = pd.Timestamp.today().normalize()
+    return (min(particao['inicio'] for particao in particoes),
+            max(particao['fim'] if particao['fim'] is not None else hoje for particao in particoes))
+
+
+def meses_particoes(particoes):
+    # Índices de mês (ano * 12 + mês) do início e do fim das partições, ou None se alguma for aberta
+    inicios = [particao['inicio'] for particao in particoes]
+    fins = [particao['fim'] for particao in particoes]
+    inicio = None if None in inicios else min(inicios)
+    fim = None if None in fins else max(fins)
+    return (None if inicio is None else inicio.year * 12 + inicio.month - 1,
+            None if fim is None else fim.year * 12 + fim.month - 1)
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def versao_planilha(file_id, site_id, drive_id, graph_url, _headers):
+    return obter_versao_arquivo(_headers, file_id, site_id, drive_id, graph_url)
+
+
+@st.cache_resource(show_spinner=False)
+def planilha_em_memoria(file_id, planilha):
+    # Uma entrada por planilha, com apenas a última versão lida: ao mudar o eTag a versão anterior é descartada
+    return {'versao': None, 'dataframe': None, 'lock': threading.Lock()}
+
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def particoes_em_memoria(chaves):
+    # Uma entrada por conjunto de partições (depende da poda), também só com a última versão
+    return {'versao': None, 'dataframe': None, 'lock': threading.Lock()}
+
+
+def obter_ultima_versao(entrada, versao, carregar):
+    # Recarrega a entrada quando a versão muda; o dataframe é compartilhado entre as sessões
+    with entrada['lock']:
+        if entrada['versao'] != versao:
+            entrada['dataframe'] = None
+            entrada['dataframe'] = carregar()
+            entrada['versao'] = versao
+        return entrada['dataframe']
+
+
+def carregar_planilha(file_id, planilha, versao, site_id, drive_id, graph_url, headers):
+    # Cada planilha é baixada e lida uma vez por versão
+    def ler_planilha():
+        conteudo = download_file_from_sharepoint(headers, file_id, site_id, drive_id, graph_url)
+        dataframe = pd.read_excel(conteudo, sheet_name=planilha)
+        for coluna in ('data', 'data_pag'):
+            if coluna in dataframe.columns:
+                dataframe[coluna] = pd.to_datetime(dataframe[coluna])
+        return dataframe
+
+    return obter_ultima_versao(planilha_em_memoria(file_id, planilha), versao, ler_planilha)
+
+
+def unir_particoes(chaves, versao, particoes):
+    # Com uma única partição não há o que concatenar
+    if len(particoes) == 1:
+        return particoes[0]
+    return obter_ultima_versao(particoes_em_memoria(chaves), versao,
+                               lambda: pd.concat(particoes, ignore_index=True))
+
+
+# ====================================================================
+# FUNÇÕES DATASET COMPARTILHADO (ARROW)
+# ====================================================================
+
+ARQUIVO_VERSAO_ARROW = 'ATUAL'
+ARQUIVO_VERSAO_ANTERIOR_ARROW = 'ANTERIOR'
+ARQUIVO_LOCK_ARROW = 'publicando.lock'
+TABELAS_ARROW = ('horas', 'pagamentos', 'processados')
+
+
+def versao_arrow_atual(diretorio, ttl_segundos=None, ponteiro=ARQUIVO_VERSAO_ARROW):
+    # Retorna a versão publicada, ou None se não existir ou estiver mais velha que o TTL
+    caminho = os.path.join(diretorio, ponteiro)
+    try:
+        if ttl_segundos is not None and time.time() - os.path.getmtime(caminho) > ttl_segundos:
+            return None
+        with open(caminho) as arquivo:
+            return arquivo.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def adquirir_lock_arrow(diretorio, lock_expirado_segundos=900):
+    os.makedirs(diretorio, exist_ok=True)
+    caminho = os.path.join(diretorio, ARQUIVO_LOCK_ARROW)
+    try:
+        # Remove locks deixados por processos que morreram durante a publicação
+        if time.time() - os.path.getmtime(caminho) > lock_expirado_segundos:
+            os.remove(caminho)
+    except FileNotFoundError:
+        pass
+    try:
+        os.close(os.open(caminho, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except FileExistsError:
+        return False
+
+
+def liberar_lock_arrow(diretorio):
+    try:
+        os.remove(os.path.join(diretorio, ARQUIVO_LOCK_ARROW))
+    except FileNotFoundError:
+        pass
+
+
+def normalizar_para_arrow(dataframe):
+    # Colunas do Excel com tipos misturados são gravadas como texto
+    dataframe = dataframe.copy()
+    for coluna in dataframe.columns[dataframe.dtypes == object]:
+        dataframe[coluna] = dataframe[coluna].where(dataframe[coluna].isna(), dataframe[coluna].astype(str))
+    return pa.Table.from_pandas(dataframe, preserve_index=False)
+
+
+def gravar_ponteiro_arrow(diretorio, ponteiro, versao):
+    temporario = os.path.join(diretorio, f"{ponteiro}.{os.getpid()}.tmp")
+    with open(temporario, 'w') as arquivo:
+        arquivo.write(versao)
+    os.replace(temporario, os.path.join(diretorio, ponteiro))
+
+
+def remover_diretorio_arrow(caminho):
+    # Melhor esforço: no Windows os arquivos ainda mapeados por outro processo não podem ser removidos e
+    # ficam para a próxima publicação
+    try:
+        shutil.rmtree(caminho)
+    except OSError:
+        pass
+
+
+def publicar_dataset_arrow(diretorio, versao, tabelas):
+    # Grava a nova versão em um diretório temporário e publica com renames atômicos
+    destino = os.path.join(diretorio, versao)
+    if not os.path.isdir(destino):
+        temporario = f"{destino}.{os.getpid()}.tmp"
+        os.makedirs(temporario, exist_ok=True)
+        for nome, dataframe in tabelas.items():
+            tabela = normalizar_para_arrow(dataframe)
+            with pa.OSFile(os.path.join(temporario, f"{nome}.arrow"), 'wb') as arquivo:
+                with pa.ipc.new_file(arquivo, tabela.schema) as writer:
+                    writer.write_table(tabela)
+        try:
+            os.replace(temporario, destino)
+        except OSError:
+            # Outro processo publicou a mesma versão ao mesmo tempo (lock expirado): vale a que já está lá
+            if not os.path.isdir(destino):
+                raise
+            remover_diretorio_arrow(temporario)
+
+    # A versão anterior só muda quando a publicada é outra; uma renovação pelo TTL com os mesmos dados
+    # mantém a anterior registrada
+    versao_atual = versao_arrow_atual(diretorio)
+    if versao_atual is not None and versao_atual != versao:
+        gravar_ponteiro_arrow(diretorio, ARQUIVO_VERSAO_ANTERIOR_ARROW, versao_atual)
+    gravar_ponteiro_arrow(diretorio, ARQUIVO_VERSAO_ARROW, versao)
+    versao_anterior = versao_arrow_atual(diretorio, ponteiro=ARQUIVO_VERSAO_ANTERIOR_ARROW)
+
+    # Mantém apenas a versão atual e a anterior (processos podem ainda estar com ela mapeada)
+    for nome in os.listdir(diretorio):
+        caminho = os.path.join(diretorio, nome)
+        if os.path.isdir(caminho) and not nome.endswith('.tmp') and nome not in (versao, versao_anterior):
+            remover_diretorio_arrow(caminho)
+
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def mapear_dataset_arrow(diretorio, versao):
+    # Mapeia os arquivos em memória: colunas numéricas e de texto referenciam o mmap sem cópia
+    tipos_texto = {pa.string(): pd.StringDtype('pyarrow'), pa.large_string(): pd.StringDtype('pyarrow')}
+    dataframes = {}
+    for nome in TABELAS_ARROW:
+        origem = pa.memory_map(os.path.join(diretorio, versao, f"{nome}.arrow"), 'r')
+        tabela = pa.ipc.open_file(origem).read_all()
+        dataframes[nome] = tabela.to_pandas(split_blocks=True, types_mapper=tipos_texto.get)
+    return dataframes
+
+
+# ====================================================================
+# FUNÇÕES CRUZAMENTO TABELA HORAS E PAGAMENTOS
+# ====================================================================
+
+def process_data(horas_df, pagamentos_df):
+    # As colunas de data já chegam convertidas (carregar_planilha); os dataframes são compartilhados e não
+    # podem ser alterados aqui
+    # Agrupa os dados mensais somando as colunas especificadas
+    horas_mensais = horas_df.resample('ME', on='data')['duracao', 'cobranca', 'custo'].sum().reset_index()
+    pagamentos_mensais = pagamentos_df.resample('ME', on='data_pag')['valor_pag'].sum().reset_index()
+
+    # Mescla os dados de horas e pagamentos com base nas datas
+    merged_data = pd.merge(horas_mensais, pagamentos_mensais, left_on='data', right_on='data_pag', how='left')
+    merged_data = merged_data.rename(columns={'duracao': 'Horas Trabalhadas', 'valor_pag': 'Valor Pago'})
+    merged_data = merged_data.fillna(0)
+
+    # Desloca o valor pago para o mês anterior para cálculos
+    merged_data['Valor Pago Anterior'] = merged_data['Valor Pago'].shift(-1).fillna(0)
+
+    # Calcula a diferença percentual entre o valor pago e a cobrança
+    merged_data['Diferença % Pago/Cobrança'] = ((merged_data['Valor Pago Anterior'] - merged_data['cobranca']) /
+                                                merged_data['cobranca'].replace(0, 1)) * 100
+
+    # Calcula a diferença percentual entre o valor pago e o custo
+    merged_data['Diferença % Pago/Custo'] = ((merged_data['Valor Pago Anterior'] - merged_data['custo']) /
+                                             merged_data['custo'].replace(0, 1)) * 100
+
+    # Calcula a margem de lucro bruta
+    merged_data['Margem de Lucro Bruta'] = ((merged_data['Valor Pago Anterior'] - merged_data['custo']) /
+                                            merged_data['Valor Pago Anterior'].replace(0, 1)) * 100
+
+    return merged_data
+
+
 # Autenticação usando MSAL
 client_id = st.secrets["sharepoint"]["client_id"]
 client_secret = st.secrets["sharepoint"]["client_secret"]
@@ -56,15 +320,65 @@ headers = {
 # Configurações do SharePoint
 site_id = st.secrets["sharepoint"]["site_id"]
 drive_id = st.secrets["sharepoint"]["drive_id"]
-planilha_horas_id = st.secrets["sharepoint"]["planilha_horas_id"]
+particoes_horas = obter_particoes_horas(st.secrets["sharepoint"])
 planilha_pagamentos_id = st.secrets["sharepoint"]["planilha_pagamentos_id"]
+graph_url = st.secrets["sharepoint"].get("graph_url", "https://graph.microsoft.com/v1.0")
+
+# Modo dataset compartilhado: um processo publica as tabelas em arquivos Arrow e os demais mapeiam
+config_dataset = st.secrets.get("dataset", {})
+diretorio_arrow = config_dataset.get("diretorio_arrow")
+ttl_arrow = config_dataset.get("ttl_segundos", 600)
+
+def carregar_planilhas(particoes):
+    # Baixa (ou lê do cache) as partições de horas indicadas e a planilha de pagamentos
+    planilhas = [(particao['id'], particao['planilha'], particao['fechada']) for particao in particoes]
+    planilhas.append((planilha_pagamentos_id, 0, False))
+
+    try:
+        # Partições fechadas nunca mudam: não é preciso consultar a versão
+        versoes = [('fechada' if fechada else versao_planilha(file_id, site_id, drive_id, graph_url, headers))
+                   for file_id, _, fechada in planilhas]
+        dataframes = [carregar_planilha(file_id, planilha, versao, site_id, drive_id, graph_url, headers)
+                      for (file_id, planilha, _), versao in zip(planilhas, versoes)]
+    except requests.exceptions.HTTPError as e:
+        st.error(f"Erro ao baixar arquivos: {e}")
+        st.stop()
+
+    # Versão dos dados - usada como chave dos caches que dependem das planilhas
+    versao = hashlib.md5('|'.join(f"{file_id}:{planilha}:{versao}" for (file_id, planilha, _), versao
+                                  in zip(planilhas, versoes)).encode('utf-8')).hexdigest()
+    chaves = tuple((file_id, planilha) for file_id, planilha, _ in planilhas[:-1])
+    return unir_particoes(chaves, versao, dataframes[:-1]), dataframes[-1], versao
+
+
+versao_dados = None
+if diretorio_arrow:
+    versao_dados = versao_arrow_atual(diretorio_arrow, ttl_arrow)
+    if versao_dados is None and adquirir_lock_arrow(diretorio_arrow):
+        # Publicação completa (todas as partições), independente do login; o lock é sempre liberado
+        try:
+            horas_publicadas, pagamentos_publicados, versao_publicada = carregar_planilhas(particoes_horas)
+            publicar_dataset_arrow(diretorio_arrow, versao_publicada, {
+                'horas': horas_publicadas,
+                'pagamentos': pagamentos_publicados,
+                'processados': process_data(horas_publicadas, pagamentos_publicados)
+            })
+        finally:
+            liberar_lock_arrow(diretorio_arrow)
+    if versao_dados is None:
+        # Versão recém-publicada ou, se outro processo está publicando, a versão anterior
+        versao_dados = versao_arrow_atual(diretorio_arrow)
+
+# Baixar arquivos - apenas as partições do intervalo de datas selecionado
+usar_arrow = versao_dados is not None
+if usar_arrow:
+    particoes_carregadas = particoes_horas
+else:
+    particoes_carregadas = podar_particoes(particoes_horas, st.session_state.get('intervalo_datas'))
+    dados_horas, dados_pagamentos, versao_dados = carregar_planilhas(particoes_carregadas)
 
-# Baixar arquivos
-try:
-    file_content_hours = download_file_from_sharepoint(headers, planilha_horas_id, site_id, drive_id)
-    file_content_payments = download_file_from_sharepoint(headers, planilha_pagamentos_id, site_id, drive_id)
-except requests.exceptions.HTTPError as e:
-    st.error(f"Erro ao baixar arquivos: {e}")
+# Meses cobertos pelas partições carregadas (None = sem limite) - restringe os pagamentos da conciliação
+meses_carregados = meses_particoes(particoes_carregadas)
 
 
 # ====================================================================
@@ -97,9 +411,11 @@ else:
 
 if st.session_state['authenticated']:
 
-    # Carregar dados
-    dados_horas = pd.read_excel(file_content_hours, sheet_name='horas_resolv')
-    dados_pagamentos = pd.read_excel(file_content_payments)
+    # Carregar dados (fora do modo compartilhado as planilhas já foram carregadas acima)
+    if usar_arrow:
+        dataset_arrow = mapear_dataset_arrow(diretorio_arrow, versao_dados)
+        dados_horas = dataset_arrow['horas']
+        dados_pagamentos = dataset_arrow['pagamentos']
 
     # ====================================================================
     # CSS CONFIGS
@@ -121,6 +437,7 @@ if st.session_state['authenticated']:
         st.session_state['executante_selecionado'] = 'Todos'
         st.session_state['tipo_hora_selecionado'] = 'Todos'
         st.session_state['cliente_selecionado'] = []
+        st.session_state['pesquisa_cliente'] = ''
 
 
     def wrap_text(text, width):
@@ -130,53 +447,259 @@ if st.session_state['authenticated']:
         return '<br>'.join(text[i:i + width] for i in range(0, len(text), width))
 
 
+    if usar_arrow:
+        dados_processados = dataset_arrow['processados']
+    else:
+        dados_processados = process_data(dados_horas, dados_pagamentos)
+
+
     # ====================================================================
-    # FUNÇÕES CRUZAMENTO TABELA HORAS E PAGAMENTOS
+    # FUNÇÕES CONCILIAÇÃO COBRANÇA X PAGAMENTO POR CLIENTE
     # ====================================================================
-    def process_data(horas_df, pagamentos_df):
-        # Converte as colunas de data para o formato datetime
-        horas_df['data'] = pd.to_datetime(horas_df['data'])
-        pagamentos_df['data_pag'] = pd.to_datetime(pagamentos_df['data_pag'])
+    def indice_mes(serie_datas):
+        # Converte datas em um índice inteiro de mês (ano * 12 + mês) para joins ordenados
+        return serie_datas.dt.year * 12 + serie_datas.dt.month - 1
+
+
+    def data_do_indice_mes(serie_indices):
+        # Converte o índice inteiro de mês de volta para o último dia do mês
+        inicio_mes = pd.to_datetime(pd.DataFrame({'year': serie_indices // 12,
+                                                  'month': serie_indices % 12 + 1,
+                                                  'day': 1}))
+        return inicio_mes + pd.offsets.MonthEnd(0)
+
+
+    @st.cache_resource(max_entries=8, show_spinner=False)
+    def conciliar_clientes(versao, defasagem_meses, meses_carregados, _horas_df, _pagamentos_df):
+        # Os dataframes não são hasheados pelo cache: a chave é a versão dos dados e a defasagem
+        # O resultado é compartilhado entre as sessões (sem cópia por execução) e só é lido, nunca alterado
+        cobrancas = _horas_df[['cliente', 'data', 'duracao', 'cobranca', 'custo']].dropna(subset=['cliente', 'data'])
+        cobrancas['mes'] = indice_mes(pd.to_datetime(cobrancas['data']))
+        cobrancas_mensais = cobrancas.groupby(['cliente', 'mes'], sort=False)[
+            ['duracao', 'cobranca', 'custo']].sum().reset_index()
+
+        pagamentos = _pagamentos_df[['cliente', 'data_pag', 'valor_pag']].copy()
+        pagamentos = pagamentos.dropna(subset=['cliente', 'data_pag'])
+        # Mês de cobrança esperado para cada pagamento, considerando a defasagem configurada
+        pagamentos['mes'] = indice_mes(pd.to_datetime(pagamentos['data_pag'])) - defasagem_meses
+
+        # Com partições podadas, descarta pagamentos que se referem a meses de horas não carregados
+        mes_inicio, mes_fim = meses_carregados
+        if mes_inicio is not None:
+            pagamentos = pagamentos[pagamentos['mes'] >= mes_inicio]
+        if mes_fim is not None:
+            pagamentos = pagamentos[pagamentos['mes'] <= mes_fim]
+
+        # Associa cada pagamento ao mês de cobrança mais próximo anterior ou igual (as-of join por cliente)
+        pagamentos = pd.merge_asof(
+            pagamentos.sort_values('mes'),
+            cobrancas_mensais[['cliente', 'mes']].assign(mes_cobranca=cobrancas_mensais['mes']).sort_values('mes'),
+            on='mes',
+            by='cliente',
+            direction='backward'
+        )
+
+        sem_cobranca = pagamentos['mes_cobranca'].isna()
+        pagamentos_sem_cobranca = pagamentos.loc[sem_cobranca, ['cliente', 'data_pag', 'valor_pag']]
+
+        pagamentos_mensais = pagamentos.loc[~sem_cobranca].groupby(['cliente', 'mes_cobranca'], sort=False)[
+            'valor_pag'].sum().reset_index()
+        pagamentos_mensais['mes_cobranca'] = pagamentos_mensais['mes_cobranca'].astype('int64')
+
+        conciliacao = pd.merge(cobrancas_mensais, pagamentos_mensais,
+                               left_on=['cliente', 'mes'], right_on=['cliente', 'mes_cobranca'], how='left')
+        conciliacao = conciliacao.drop(columns='mes_cobranca').rename(columns={'valor_pag': 'Valor Pago'})
+        conciliacao['Valor Pago'] = conciliacao['Valor Pago'].fillna(0)
+        conciliacao['data'] = data_do_indice_mes(conciliacao['mes'])
+        conciliacao['Saldo'] = conciliacao['Valor Pago'] - conciliacao['cobranca']
+        conciliacao = conciliacao.sort_values(['cliente', 'mes']).reset_index(drop=True)
 
-        # Agrupa os dados mensais somando as colunas especificadas
-        horas_mensais = horas_df.resample('ME', on='data')['duracao', 'cobranca', 'custo'].sum().reset_index()
-        pagamentos_mensais = pagamentos_df.resample('ME', on='data_pag')['valor_pag'].sum().reset_index()
+        return conciliacao, pagamentos_sem_cobranca
+
+
+    def resumir_conciliacao(conciliacao):
+        resumo = conciliacao.groupby('cliente').agg({
+            'duracao': 'sum',
+            'cobranca': 'sum',
+            'custo': 'sum',
+            'Valor Pago': 'sum',
+            'Saldo': 'sum'
+        }).reset_index()
+        resumo['Diferença % Pago/Cobrança'] = (resumo['Saldo'] / resumo['cobranca'].replace(0, 1)) * 100
+        resumo = resumo.rename(columns={'cliente': 'Cliente', 'duracao': 'Horas Trabalhadas',
+                                        'cobranca': 'Cobrança', 'custo': 'Custo'})
+        return resumo.sort_values('Saldo')
+
+
+    def detalhar_conciliacao(conciliacao):
+        # Uma linha por cliente e mês, com os mesmos nomes de coluna do resumo
+        detalhe = conciliacao[['cliente', 'data', 'duracao', 'cobranca', 'custo', 'Valor Pago', 'Saldo']]
+        return detalhe.rename(columns={'cliente': 'Cliente', 'data': 'Mês', 'duracao': 'Horas Trabalhadas',
+                                       'cobranca': 'Cobrança', 'custo': 'Custo'})
+
+
+    # ====================================================================
+    # FUNÇÕES ÍNDICE DIÁRIO (MÉTRICAS)
+    # ====================================================================
+    COLUNAS_METRICAS = ['duracao', 'cobranca', 'custo']
 
-        # Mescla os dados de horas e pagamentos com base nas datas
-        merged_data = pd.merge(horas_mensais, pagamentos_mensais, left_on='data', right_on='data_pag', how='left')
-        merged_data = merged_data.rename(columns={'duracao': 'Horas Trabalhadas', 'valor_pag': 'Valor Pago'})
-        merged_data = merged_data.fillna(0)
 
-        # Desloca o valor pago para o mês anterior para cálculos
-        merged_data['Valor Pago Anterior'] = merged_data['Valor Pago'].shift(-1).fillna(0)
+    @st.cache_resource(max_entries=4, show_spinner=False)
+    def indice_diario(versao, _horas_df):
+        # Somas acumuladas diárias por tipo de hora - geral, por área e por executante
+        datas = pd.to_datetime(_horas_df['data']).dt.normalize().rename('dia')
+        dias = pd.date_range(datas.min(), datas.max(), freq='D')
+        valores = _horas_df[COLUNAS_METRICAS].astype(float)
 
-        # Calcula a diferença percentual entre o valor pago e a cobrança
-        merged_data['Diferença % Pago/Cobrança'] = ((merged_data['Valor Pago Anterior'] - merged_data['cobranca']) /
-                                                    merged_data['cobranca'].replace(0, 1)) * 100
+        acumulados = {}
+        for dimensao in (None, 'área', 'executante'):
+            chaves = [datas] + ([_horas_df[dimensao]] if dimensao else []) + [_horas_df['tipo_hora']]
+            diario = valores.groupby(chaves, dropna=False).sum()
+            diario = diario.unstack(list(range(1, len(chaves))), fill_value=0).reindex(dias, fill_value=0)
+            # Linha de zeros no início: a soma do dia i ao dia j é acumulado[j + 1] - acumulado[i]
+            acumulado = np.vstack([np.zeros(diario.shape[1]), diario.to_numpy().cumsum(axis=0)])
+            acumulados[dimensao] = (acumulado, diario.columns)
 
-        # Calcula a diferença percentual entre o valor pago e o custo
-        merged_data['Diferença % Pago/Custo'] = ((merged_data['Valor Pago Anterior'] - merged_data['custo']) /
-                                                 merged_data['custo'].replace(0, 1)) * 100
+        return dias, acumulados
 
-        # Calcula a margem de lucro bruta
-        merged_data['Margem de Lucro Bruta'] = ((merged_data['Valor Pago Anterior'] - merged_data['custo']) /
-                                                merged_data['Valor Pago Anterior'].replace(0, 1)) * 100
 
-        return merged_data
+    def metricas_periodo(indice, inicio, fim, area, executante, tipo_hora):
+        # Totais do período com duas consultas ao índice - retorna (totais, horas por tipo de hora)
+        dias, acumulados = indice
+        if area != 'Todas':
+            dimensao, valor = 'área', area
+        elif executante != 'Todos':
+            dimensao, valor = 'executante', executante
+        else:
+            dimensao, valor = None, None
 
+        acumulado, colunas = acumulados[dimensao]
+        posicao_inicio = dias.searchsorted(inicio.normalize(), side='left')
+        posicao_fim = dias.searchsorted(fim.normalize(), side='right')
+        totais = pd.Series(acumulado[posicao_fim] - acumulado[posicao_inicio], index=colunas)
 
-    dados_processados = process_data(dados_horas, dados_pagamentos)
+        if dimensao:
+            totais = totais[totais.index.get_level_values(1) == valor].droplevel(1)
+        if tipo_hora != 'Todos':
+            totais = totais[totais.index.get_level_values(1) == tipo_hora]
+
+        totais_gerais = totais.groupby(level=0).sum().reindex(COLUNAS_METRICAS, fill_value=0)
+        return totais_gerais, totais['duracao'] if 'duracao' in totais.index else pd.Series(dtype=float)
+
+
+    # ====================================================================
+    # FUNÇÕES PESQUISA DE CLIENTES
+    # ====================================================================
+    LIMITE_SUGESTOES_CLIENTES = 20
+
+
+    def normalizar_texto(serie):
+        # Remove acentos e diferenças de maiúsculas/minúsculas
+        return (serie.astype(str).str.normalize('NFKD').str.encode('ascii', 'ignore').str.decode('ascii')
+                .str.casefold())
+
+
+    @st.cache_resource(max_entries=4, show_spinner=False)
+    def indice_clientes(versao, _horas_df):
+        codigos, clientes = pd.factorize(_horas_df['cliente'])
+        normalizados = normalizar_texto(pd.Series(clientes)).to_numpy(dtype=str)
+
+        # Nomes normalizados ordenados para a busca por prefixo
+        ordem_nomes = np.argsort(normalizados, kind='stable')
+
+        # Listas de posições das linhas por cliente (linhas sem cliente ficam de fora)
+        ordem_linhas = np.argsort(codigos, kind='stable')
+        ordem_linhas = ordem_linhas[codigos[ordem_linhas] >= 0]
+        limites_linhas = np.searchsorted(codigos[ordem_linhas], np.arange(len(clientes) + 1))
+
+        # Horas por cliente para ordenar as sugestões (durações em branco contam como zero)
+        duracao = np.nan_to_num(_horas_df['duracao'].to_numpy(dtype=float))
+        horas = np.bincount(codigos[codigos >= 0], weights=duracao[codigos >= 0], minlength=len(clientes))
+
+        return {
+            'clientes': np.asarray(clientes),
+            'codigos': {cliente: codigo for codigo, cliente in enumerate(clientes)},
+            'normalizados': normalizados,
+            'ordem_nomes': ordem_nomes,
+            'nomes_ordenados': normalizados[ordem_nomes],
+            'linhas': ordem_linhas,
+            'limites_linhas': limites_linhas,
+            'horas': horas
+        }
+
+
+    def pesquisar_clientes(indice, termo, limite=LIMITE_SUGESTOES_CLIENTES):
+        # Retorna os clientes encontrados (prefixo primeiro, depois trecho do nome) e o total de resultados
+        termo = normalizar_texto(pd.Series([termo])).iloc[0].strip()
+        if not termo:
+            encontrados = np.argsort(-indice['horas'], kind='stable')
+            return list(indice['clientes'][encontrados[:limite]]), len(encontrados)
+
+        inicio = np.searchsorted(indice['nomes_ordenados'], termo, side='left')
+        fim = np.searchsorted(indice['nomes_ordenados'], termo + '\uffff', side='left')
+        prefixo = indice['ordem_nomes'][inicio:fim]
+        trecho = np.flatnonzero(np.char.find(indice['normalizados'], termo) > 0)
+
+        # Em cada grupo, os clientes com mais horas aparecem primeiro
+        prefixo = prefixo[np.argsort(-indice['horas'][prefixo], kind='stable')]
+        trecho = trecho[np.argsort(-indice['horas'][trecho], kind='stable')]
+        encontrados = np.concatenate([prefixo, trecho])
+        return list(indice['clientes'][encontrados[:limite]]), len(encontrados)
+
+
+    def linhas_dos_clientes(indice, clientes):
+        # Une as listas de posições dos clientes selecionados, na ordem original das linhas
+        limites = indice['limites_linhas']
+        codigos = [indice['codigos'][cliente] for cliente in clientes if cliente in indice['codigos']]
+        if not codigos:
+            return np.array([], dtype=np.int64)
+        return np.sort(np.concatenate([indice['linhas'][limites[codigo]:limites[codigo + 1]] for codigo in codigos]))
+
+
+    # Saldo (Pago - Cobrança) por cliente
+    def plot_saldo_por_cliente(resumo, quantidade=15):
+        maiores_saldos = resumo.reindex(resumo['Saldo'].abs().sort_values(ascending=False).index).head(quantidade)
+        maiores_saldos = maiores_saldos.sort_values('Saldo')
+
+        fig = go.Figure()
+        fig.add_trace(go.Bar(
+            y=maiores_saldos['Cliente'],
+            x=maiores_saldos['Saldo'],
+            name='Saldo',
+            orientation='h',
+            marker_color=['#2ca02c' if saldo >= 0 else '#d62728' for saldo in maiores_saldos['Saldo']],
+            texttemplate='%{x:.3~s}',
+            textposition='outside'
+        ))
+
+        fig.update_layout(
+            title={
+                'text': f"Top {quantidade} Clientes por Saldo Pago - Cobrança (R$)",
+                'y': 1.0,
+                'x': 0.5,
+                'xanchor': 'center',
+                'yanchor': 'top'
+            },
+            title_font=dict(size=20),
+            xaxis_title="Saldo",
+            yaxis_title="Cliente",
+            height=600,
+            margin=dict(l=10, r=50, t=30, b=10)
+        )
+        fig.update_xaxes(zeroline=True, zerolinewidth=2, zerolinecolor='grey')
+
+        return fig, maiores_saldos
 
 
     # Relação entre Cobrança e Custo e Valor Pago
     def plot_hours_vs_payments(dataframe):
         fig = go.Figure()
         fig.add_trace(go.Bar(x=dataframe['data'], y=dataframe['Valor Pago'], name='Valor Pago', marker_color='#2ca02c',
-                             text=[f"{y / 1000:.0f}k" for y in dataframe['Valor Pago']], textposition='outside'))
+                             texttemplate='%{y:.3~s}', textposition='outside'))
         fig.add_trace(go.Bar(x=dataframe['data'], y=dataframe['cobranca'], name='Cobrança', marker_color='#ff7f0e',
-                             text=[f"{y / 1000:.0f}k" for y in dataframe['cobranca']], textposition='outside'))
+                             texttemplate='%{y:.3~s}', textposition='outside'))
         fig.add_trace(go.Bar(x=dataframe['data'], y=dataframe['custo'], name='Custo', marker_color='#1f77b4',
-                             text=[f"{y / 1000:.0f}k" for y in dataframe['custo']], textposition='outside'))
+                             texttemplate='%{y:.3~s}', textposition='outside'))
 
         fig.update_layout(
             title={
@@ -196,7 +719,7 @@ if st.session_state['authenticated']:
         )
 
         fig.update_yaxes(range=[0, dataframe[['cobranca', 'custo', 'Valor Pago']].max().max() * 1.2])
-        return fig
+        return fig, dataframe[['data', 'Valor Pago', 'cobranca', 'custo']]
 
 
     # Função para gráfico de diferença percentual pago/cobrança
@@ -208,7 +731,7 @@ if st.session_state['authenticated']:
             mode='lines+markers+text',
             name='Diferença % Pago/Cobrança',
             line=dict(color='#ff7f0e'),
-            text=[f"{y:.2f}%" for y in dataframe['Diferença % Pago/Cobrança']],
+            texttemplate='%{y:.2f}%',
             textposition='top center'
         ))
         fig.update_layout(
@@ -226,7 +749,7 @@ if st.session_state['authenticated']:
             title_font=dict(size=20)
         )
         fig.update_yaxes(range=[-100, 100], zeroline=True, zerolinewidth=2, zerolinecolor='grey', automargin=True)
-        return fig
+        return fig, dataframe[['data', 'Diferença % Pago/Cobrança']]
 
 
     # Função para gráfico de diferença percentual pago/custo
@@ -238,7 +761,7 @@ if st.session_state['authenticated']:
             mode='lines+markers+text',
             name='Diferença % Pago/Custo',
             line=dict(color='#2ca02c'),
-            text=[f"{y:.2f}%" for y in dataframe['Diferença % Pago/Custo']],
+            texttemplate='%{y:.2f}%',
             textposition='top center'
         ))
         fig.update_layout(
@@ -256,7 +779,7 @@ if st.session_state['authenticated']:
             title_font=dict(size=20)
         )
         fig.update_yaxes(range=[-100, 100], zeroline=True, zerolinewidth=2, zerolinecolor='grey', automargin=True)
-        return fig
+        return fig, dataframe[['data', 'Diferença % Pago/Custo']]
 
 
     # Função para gráfico de margem de lucro bruta
@@ -268,7 +791,7 @@ if st.session_state['authenticated']:
             mode='lines+markers+text',
             name='Margem de Lucro Bruta',
             line=dict(color='#1f77b4'),
-            text=[f"{y:.2f}%" for y in dataframe['Margem de Lucro Bruta']],
+            texttemplate='%{y:.2f}%',
             textposition='top center'
         ))
         fig.update_layout(
@@ -286,16 +809,16 @@ if st.session_state['authenticated']:
             title_font=dict(size=20)
         )
         fig.update_yaxes(range=[-100, 100], zeroline=True, zerolinewidth=2, zerolinecolor='grey', automargin=True)
-        return fig
+        return fig, dataframe[['data', 'Margem de Lucro Bruta']]
 
 
     # Relação entre Cobrança e Custo
     def plot_cobranca_vs_custo(dataframe):
         fig = go.Figure()
         fig.add_trace(go.Bar(x=dataframe['data'], y=dataframe['cobranca'], name='Cobrança', marker_color='#ff7f0e',
-                             text=[f"{y / 1000:.0f}k" for y in dataframe['cobranca']], textposition='outside'))
+                             texttemplate='%{y:.3~s}', textposition='outside'))
         fig.add_trace(go.Bar(x=dataframe['data'], y=dataframe['custo'], name='Custo', marker_color='#1f77b4',
-                             text=[f"{y / 1000:.0f}k" for y in dataframe['custo']], textposition='outside'))
+                             texttemplate='%{y:.3~s}', textposition='outside'))
 
         fig.update_layout(
             title={
@@ -315,7 +838,7 @@ if st.session_state['authenticated']:
         )
 
         fig.update_yaxes(range=[0, dataframe[['cobranca', 'custo']].max().max() * 1.2])
-        return fig
+        return fig, dataframe[['data', 'cobranca', 'custo']]
 
 
     # ====================================================================
@@ -331,9 +854,8 @@ if st.session_state['authenticated']:
                      title='Horas Trabalhadas por Área',
                      labels={'duracao': 'Horas Trabalhadas', 'área': 'Área'},
                      color='duracao',
-                     text='duracao',
                      color_continuous_scale=px.colors.sequential.Viridis)
-        fig.update_traces(texttemplate='%{text}', textposition='outside')
+        fig.update_traces(texttemplate='%{y}', textposition='outside')
         fig.update_layout(xaxis_title="Área",
                           yaxis_title="Horas Trabalhadas",
                           uniformtext_minsize=8,
@@ -352,7 +874,7 @@ if st.session_state['authenticated']:
             },
             title_font=dict(size=20)
         )
-        return fig
+        return fig, area_hours
 
 
     # Horas por executante
@@ -390,11 +912,11 @@ if st.session_state['authenticated']:
         )
         fig.update_yaxes(autorange="reversed")
 
-        return fig
+        return fig, executante_hours
 
 
     # Horas lançadas por dia - evolução
-    def plot_hours_over_time(dataframe):
+    def plot_hours_over_time(dataframe, compacto=False):
         dataframe['duracao'] = dataframe['duracao'].astype(float)
         dataframe['data'] = pd.to_datetime(dataframe['data'])
         date_hours = dataframe.resample('W-Mon', on='data')['duracao'].sum().reset_index().sort_values('data')
@@ -406,13 +928,17 @@ if st.session_state['authenticated']:
                       markers=True,
                       color_discrete_sequence=px.colors.sequential.Blugrn)
 
-        for data_pt in date_hours.itertuples():
-            fig.add_annotation(x=data_pt.data, y=data_pt.duracao,
-                               text=f"{data_pt.duracao:.2f}",
-                               showarrow=True,
-                               arrowhead=1,
-                               ax=0,
-                               ay=-20)
+        if compacto:
+            # Rótulos via template no próprio traço, em vez de uma anotação por ponto
+            fig.update_traces(mode='lines+markers+text', texttemplate='%{y:.2f}', textposition='top center')
+        else:
+            for data_pt in date_hours.itertuples():
+                fig.add_annotation(x=data_pt.data, y=data_pt.duracao,
+                                   text=f"{data_pt.duracao:.2f}",
+                                   showarrow=True,
+                                   arrowhead=1,
+                                   ax=0,
+                                   ay=-20)
 
         fig.update_layout(
             autosize=True,
@@ -426,7 +952,7 @@ if st.session_state['authenticated']:
             margin=dict(l=10, r=10, t=60, b=10)  # Ajusta a margem superior para mais espaço
         )
 
-        return fig
+        return fig, date_hours
 
 
     # Top horas por cliente
@@ -464,7 +990,7 @@ if st.session_state['authenticated']:
         )
         fig.update_yaxes(autorange="reversed")
 
-        return fig
+        return fig, client_hours
 
 
     # Tipos de hora trabalhadas
@@ -507,7 +1033,7 @@ if st.session_state['authenticated']:
         fig.update_xaxes(range=[0, tipo_service['duracao'].max() * 1.2])
         fig.update_yaxes(categoryorder='total descending')
 
-        return fig
+        return fig, tipo_service
 
 
     # Horas / Cobrança / Custo por Tipo de Serviço
@@ -535,15 +1061,10 @@ if st.session_state['authenticated']:
         # Ordenar os tipos de serviço pela soma das horas trabalhadas
         tipo_service_data = tipo_service_data.sort_values('duracao', ascending=False).head(10)
 
-        # Criar a coluna de texto combinada
-        tipo_service_data['text'] = (
-                tipo_service_data['duracao'].round(2).astype(str) + ' horas - ' +
-                (tipo_service_data['cobranca'] / 1000).round(2).astype(str) + 'k (' + tipo_service_data[
-                    'percent_cobranca'].round(2).astype(str) + '%) - ' +
-                (tipo_service_data['custo'] / 1000).round(2).astype(str) + 'k (' + tipo_service_data[
-                    'percent_custo'].round(
-            2).astype(str) + '%)'
-        )
+        # Valores do texto combinado (formatados no navegador pelo texttemplate)
+        tipo_service_data['cobranca_mil'] = tipo_service_data['cobranca'] / 1000
+        tipo_service_data['custo_mil'] = tipo_service_data['custo'] / 1000
+        dados_texto = tipo_service_data[['cobranca_mil', 'percent_cobranca', 'custo_mil', 'percent_custo']]
 
         fig = go.Figure()
 
@@ -554,7 +1075,11 @@ if st.session_state['authenticated']:
             name='Informações Combinadas',
             orientation='h',
             marker=dict(color=tipo_service_data['duracao'], colorscale='Rainbow'),
-            text=tipo_service_data['text'],
+            customdata=dados_texto.to_numpy(),
+            texttemplate='%{x:.2f} horas - %{customdata[0]:.2f}k (%{customdata[1]:.2f}%) - '
+                         '%{customdata[2]:.2f}k (%{customdata[3]:.2f}%)',
+            hovertemplate='%{y}<br>%{x:.2f} horas<br>Cobrança: %{customdata[0]:.2f}k (%{customdata[1]:.2f}%)<br>'
+                          'Custo: %{customdata[2]:.2f}k (%{customdata[3]:.2f}%)<extra></extra>',
             textposition='outside'
         ))
 
@@ -585,28 +1110,87 @@ if st.session_state['authenticated']:
             )
         )
 
-        return fig
+        return fig, tipo_service_data[['tipo', 'duracao', 'cobranca', 'custo', 'percent_horas', 'percent_cobranca',
+                                       'percent_custo']]
+
+
+    # Códigos inteiros de tipo de serviço e pasta, calculados uma vez por versão dos dados
+    @st.cache_resource(max_entries=4, show_spinner=False)
+    def codificar_tipo_pasta(versao, _horas_df):
+        codigos_tipo, tipos = pd.factorize(_horas_df['tipo'])
+        codigos_pasta, pastas = pd.factorize(_horas_df['vinculo_processo_servico'])
+        codigos = pd.DataFrame({'tipo': codigos_tipo, 'pasta': codigos_pasta}, index=_horas_df.index)
+        return codigos, np.asarray(tipos), len(pastas)
+
+
+    # Horas por (tipo, pasta, dia), calculadas uma vez por versão dos dados e ordenadas por par (tipo, pasta)
+    @st.cache_resource(max_entries=4, show_spinner=False)
+    def parciais_tipo_pasta(versao, _horas_df, _codigos):
+        validos = (_codigos['tipo'].to_numpy() >= 0) & (_codigos['pasta'].to_numpy() >= 0)
+        parciais = pd.DataFrame({
+            'tipo': _codigos['tipo'].to_numpy()[validos],
+            'pasta': _codigos['pasta'].to_numpy()[validos],
+            'dia': pd.to_datetime(_horas_df['data']).dt.normalize().to_numpy()[validos],
+            'duracao': np.nan_to_num(_horas_df['duracao'].to_numpy(dtype=float)[validos])
+        }).groupby(['tipo', 'pasta', 'dia']).sum().reset_index()
+
+        # Início de cada par (tipo, pasta) na tabela ordenada
+        codigo_tipo = parciais['tipo'].to_numpy()
+        codigo_pasta = parciais['pasta'].to_numpy()
+        inicios = np.flatnonzero(np.r_[True, (np.diff(codigo_tipo) != 0) | (np.diff(codigo_pasta) != 0)])
+        inicios = inicios[inicios < len(parciais)]
+        return parciais['dia'].to_numpy(), parciais['duracao'].to_numpy(), codigo_tipo, codigo_pasta, inicios
+
+
+    def contar_tipo_pasta_periodo(parciais, inicio, fim, quantidade_tipos, quantidade_pastas):
+        # Une os parciais diários do intervalo, sem percorrer as linhas: retorna (horas por tipo, pastas por
+        # tipo, total de pastas)
+        dias, duracao, codigo_tipo, codigo_pasta, inicios = parciais
+        no_periodo = (dias >= inicio.normalize().to_datetime64()) & (dias <= fim.normalize().to_datetime64())
+        horas_por_tipo = np.bincount(codigo_tipo, weights=duracao * no_periodo, minlength=quantidade_tipos)
+
+        # Um par (tipo, pasta) entra na contagem se tiver horas em algum dia do intervalo
+        pares_ativos = np.logical_or.reduceat(no_periodo, inicios) if len(inicios) else np.zeros(0, dtype=bool)
+        pastas_por_tipo = np.bincount(codigo_tipo[inicios][pares_ativos], minlength=quantidade_tipos)
+        total_pastas = np.count_nonzero(np.bincount(codigo_pasta[inicios][pares_ativos],
+                                                    minlength=quantidade_pastas))
+        return horas_por_tipo, pastas_por_tipo, total_pastas
+
+
+    def contar_tipo_pasta_linhas(dataframe, codigos, quantidade_tipos, quantidade_pastas):
+        # Mesmos totais a partir das linhas filtradas - usado quando há filtros além do intervalo de datas
+        # Códigos das linhas filtradas (linhas sem tipo de serviço ou sem pasta ficam de fora, como no groupby)
+        codigos_filtrados = codigos.loc[dataframe.index]
+        validos = (codigos_filtrados['tipo'].to_numpy() >= 0) & (codigos_filtrados['pasta'].to_numpy() >= 0)
+        codigo_tipo = codigos_filtrados['tipo'].to_numpy()[validos]
+        codigo_pasta = codigos_filtrados['pasta'].to_numpy()[validos]
+        # Durações em branco contam como zero (o sum do pandas ignora NaN; o bincount propagaria)
+        duracao = np.nan_to_num(dataframe['duracao'].to_numpy(dtype=float)[validos])
+
+        # Soma das horas por tipo de serviço
+        horas_por_tipo = np.bincount(codigo_tipo, weights=duracao, minlength=quantidade_tipos)
+
+        # Pares (tipo, pasta) distintos codificados em um inteiro - a contagem por tipo dá as pastas únicas
+        pares = np.unique(codigo_tipo.astype(np.int64) * quantidade_pastas + codigo_pasta)
+        pastas_por_tipo = np.bincount(pares // quantidade_pastas, minlength=quantidade_tipos)
+        total_pastas = np.count_nonzero(np.bincount(codigo_pasta, minlength=quantidade_pastas))
+        return horas_por_tipo, pastas_por_tipo, total_pastas
 
 
     # Média de Horas / Qtidade de Pasta por Tipo de Serviço
-    def plot_avg_hours_per_service_by_folder(dataframe):
-        dataframe['duracao'] = dataframe['duracao'].astype(float)
-
-        # Agrupar por tipo de serviço e pasta para obter a soma das horas por pasta e serviço
-        service_folder_hours = dataframe.groupby(['tipo', 'vinculo_processo_servico'])['duracao'].sum().reset_index()
-
-        # Agrupar novamente por tipo de serviço para obter a soma total das horas e a quantidade de pastas únicas
-        avg_hours_per_service = service_folder_hours.groupby('tipo').agg({
-            'duracao': 'sum',
-            'vinculo_processo_servico': pd.Series.nunique
-        }).reset_index()
+    def plot_avg_hours_per_service_by_folder(tipos, horas_por_tipo, pastas_por_tipo, total_pastas):
+        avg_hours_per_service = pd.DataFrame({
+            'tipo': tipos,
+            'duracao': horas_por_tipo,
+            'vinculo_processo_servico': pastas_por_tipo
+        })
+        avg_hours_per_service = avg_hours_per_service[avg_hours_per_service['vinculo_processo_servico'] > 0].copy()
 
         # Calcular a média das horas por pasta para cada tipo de serviço
         avg_hours_per_service['avg_hours'] = avg_hours_per_service['duracao'] / avg_hours_per_service[
             'vinculo_processo_servico']
 
         # Calcular o percentual de pastas do total
-        total_pastas = service_folder_hours['vinculo_processo_servico'].nunique()
         avg_hours_per_service['percent_pastas'] = (avg_hours_per_service[
                                                        'vinculo_processo_servico'] / total_pastas) * 100
 
@@ -614,13 +1198,15 @@ if st.session_state['authenticated']:
         avg_hours_per_service = avg_hours_per_service.sort_values(by='vinculo_processo_servico', ascending=False).head(
             10)
 
+        # Tabela agregada com os nomes completos, antes da quebra de texto
+        agregado = avg_hours_per_service[['tipo', 'duracao', 'vinculo_processo_servico', 'avg_hours',
+                                          'percent_pastas']].copy()
+
         # Quebrar o texto dos tipos de serviço
         avg_hours_per_service['tipo'] = avg_hours_per_service['tipo'].apply(lambda x: wrap_text(x, 30))
 
-        # Criar a coluna de texto combinada
-        avg_hours_per_service['text'] = avg_hours_per_service['avg_hours'].round(2).astype(str) + ' horas - ' + \
-                                        avg_hours_per_service['vinculo_processo_servico'].astype(str) + ' pastas (' + \
-                                        avg_hours_per_service['percent_pastas'].round(2).astype(str) + '%)'
+        # Valores do texto combinado (formatados no navegador pelo texttemplate)
+        dados_texto = avg_hours_per_service[['vinculo_processo_servico', 'percent_pastas']]
 
         # Criar gráfico de barras horizontais com a média de horas por pasta
         fig = go.Figure()
@@ -632,7 +1218,10 @@ if st.session_state['authenticated']:
             name='Média de Horas por Pasta',
             orientation='h',
             marker=dict(color=avg_hours_per_service['avg_hours'], colorscale='Rainbow'),  # Aplicar cores
-            text=avg_hours_per_service['text'],
+            customdata=dados_texto.to_numpy(),
+            texttemplate='%{x:.2f} horas - %{customdata[0]} pastas (%{customdata[1]:.2f}%)',
+            hovertemplate='%{y}<br>%{x:.2f} horas por pasta<br>%{customdata[0]} pastas '
+                          '(%{customdata[1]:.2f}%)<extra></extra>',
             textposition='outside'
         ))
 
@@ -663,9 +1252,111 @@ if st.session_state['authenticated']:
             )
         )
 
+        return fig, agregado
+
+
+    # ====================================================================
+    # FUNÇÕES PAYLOAD DOS GRÁFICOS
+    # ====================================================================
+    CASAS_DECIMAIS_GRAFICOS = 2
+
+
+    def arredondar_valores(valores):
+        array = np.asarray(valores) if valores is not None else None
+        if array is not None and array.dtype.kind == 'f':
+            return array.round(CASAS_DECIMAIS_GRAFICOS)
+        return valores
+
+
+    def compactar_figura(fig):
+        # Remove o template padrão do plotly (o tema do Streamlit é aplicado no navegador)
+        fig.layout.template = go.layout.Template()
+        for trace in fig.data:
+            trace.x = arredondar_valores(trace.x)
+            trace.y = arredondar_valores(trace.y)
+            if getattr(trace, 'marker', None) is not None and trace.marker.color is not None:
+                trace.marker.color = arredondar_valores(trace.marker.color)
+            if getattr(trace, 'customdata', None) is not None:
+                trace.customdata = arredondar_valores(trace.customdata)
         return fig
 
 
+    def exibir_grafico(nome, fig):
+        if modo_compacto:
+            compactar_figura(fig)
+        if medir_graficos:
+            tamanhos_graficos[nome] = len(pio.to_json(fig, validate=False).encode('utf-8'))
+        st.plotly_chart(fig)
+
+
+    # ====================================================================
+    # FUNÇÕES EXPORTAÇÃO
+    # ====================================================================
+    TAMANHO_BLOCO_EXPORTACAO = 50_000
+    LIMITE_LINHAS_XLSX = 1_048_575
+
+    FORMATOS_EXPORTACAO = {
+        'CSV': ('csv', 'text/csv'),
+        'XLSX': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+        'Parquet': ('parquet', 'application/vnd.apache.parquet')
+    }
+
+
+    def blocos_por_indice(dataframe, indice, tamanho_bloco=TAMANHO_BLOCO_EXPORTACAO):
+        # Lê as linhas selecionadas em blocos, sem montar uma cópia completa do recorte
+        posicoes = dataframe.index.get_indexer(indice)
+        for inicio in range(0, len(posicoes), tamanho_bloco):
+            yield dataframe.take(posicoes[inicio:inicio + tamanho_bloco])
+
+
+    def exportar_csv(blocos):
+        buffer = io.BytesIO()
+        buffer.write('\ufeff'.encode('utf-8'))  # BOM para o Excel reconhecer os acentos
+        for numero, bloco in enumerate(blocos):
+            bloco.to_csv(buffer, header=numero == 0, index=False, encoding='utf-8')
+        return buffer.getvalue()
+
+
+    def exportar_xlsx(blocos):
+        workbook = openpyxl.Workbook(write_only=True)
+        worksheet = workbook.create_sheet('dados')
+        linhas_escritas = 0
+        for numero, bloco in enumerate(blocos):
+            if numero == 0:
+                worksheet.append(list(bloco.columns))
+            bloco = bloco.head(LIMITE_LINHAS_XLSX - linhas_escritas)
+            bloco = bloco.astype(object).where(bloco.notna(), None)
+            for linha in bloco.itertuples(index=False, name=None):
+                worksheet.append(linha)
+            linhas_escritas += len(bloco)
+            if linhas_escritas >= LIMITE_LINHAS_XLSX:
+                st.warning(f"O formato XLSX foi limitado às primeiras {LIMITE_LINHAS_XLSX} linhas.")
+                break
+        buffer = io.BytesIO()
+        workbook.save(buffer)
+        return buffer.getvalue()
+
+
+    def esquema_arrow(dataframe):
+        # Esquema do arquivo a partir dos tipos do dataframe completo (colunas object viram texto)
+        esquema = pa.Schema.from_pandas(dataframe.head(0), preserve_index=False)
+        for coluna in dataframe.columns[dataframe.dtypes == object]:
+            posicao = esquema.get_field_index(coluna)
+            esquema = esquema.set(posicao, pa.field(coluna, pa.string()))
+        return esquema
+
+
+    def exportar_parquet(blocos, esquema):
+        buffer = io.BytesIO()
+        with pa.parquet.ParquetWriter(buffer, esquema) as writer:
+            for bloco in blocos:
+                writer.write_table(normalizar_para_arrow(bloco).cast(esquema))
+        return buffer.getvalue()
+
+
+    EXPORTADORES = {'CSV': exportar_csv, 'XLSX': exportar_xlsx}
+
+
     # ====================================================================
     # SIDEBAR LOGO
     # ====================================================================
@@ -686,6 +1377,11 @@ if st.session_state['authenticated']:
     # Espaço extra antes do botão
     st.sidebar.markdown('<br>', unsafe_allow_html=True)
 
+    # Opções de envio dos gráficos
+    modo_compacto = st.sidebar.checkbox('Modo compacto (conexões lentas)', value=False)
+    medir_graficos = st.sidebar.checkbox('Medir tamanho dos gráficos', value=False)
+    tamanhos_graficos = {}
+
     # ====================================================================
     # SIDEBAR FILTERS
     # ====================================================================
@@ -697,15 +1393,22 @@ if st.session_state['authenticated']:
     # ====================================================================
 
     # Define the min and max dates if not already defined
-    min_date = dados_processados['data'].min()
-    max_date = dados_processados['data'].max()
-
-    # Filtro de data com slider
+    # Com partições datadas, os limites vêm da configuração (os dados carregados podem estar podados)
+    indice_metricas = indice_diario(versao_dados, dados_horas)
+    limites_datas = limites_particoes(particoes_horas)
+    if limites_datas is None:
+        limites_datas = (indice_metricas[0].min(), indice_metricas[0].max())
+    min_date, max_date = limites_datas
+
+    # Filtro de data com slider (precisão diária)
     selected_date_range = st.sidebar.slider(
         "Selecione o intervalo de datas:",
+        min_value=min_date.to_pydatetime(),
+        max_value=max_date.to_pydatetime(),
         value=(min_date.to_pydatetime(),
                max_date.to_pydatetime()),
-        format='MM/YYYY'
+        format='DD/MM/YYYY',
+        key='intervalo_datas'
     )
 
     # Convertendo as datas selecionadas para datetime, se necessário
@@ -768,14 +1471,34 @@ if st.session_state['authenticated']:
     )
 
     # Filtro por cliente com campo de pesquisa
+    # A lista de opções traz só os clientes selecionados e as melhores sugestões para o termo pesquisado
+    indice_pesquisa_clientes = indice_clientes(versao_dados, dados_horas)
+    termo_cliente = st.sidebar.text_input('Pesquisar Cliente:', key='pesquisa_cliente')
+
+    # As opções só mudam quando o termo (ou a versão dos dados) muda; a seleção fica no estado da chave
+    if st.session_state.get('pesquisa_opcoes_cliente') != (versao_dados, termo_cliente):
+        selecionados = list(st.session_state['cliente_selecionado'])
+        sugestoes_clientes, total_encontrados = pesquisar_clientes(indice_pesquisa_clientes, termo_cliente)
+        st.session_state['opcoes_cliente'] = list(dict.fromkeys(selecionados + sugestoes_clientes))
+        st.session_state['total_clientes_encontrados'] = total_encontrados
+        st.session_state['pesquisa_opcoes_cliente'] = (versao_dados, termo_cliente)
+        st.session_state['cliente_selecionado'] = selecionados
+    if termo_cliente:
+        st.sidebar.caption(f"{st.session_state['total_clientes_encontrados']} clientes encontrados")
+
     cliente_selecionado = st.sidebar.multiselect(
         'Selecione um Cliente:',
-        options=sorted(dados_horas['cliente'].unique()),
-        default=st.session_state['cliente_selecionado']
+        options=st.session_state['opcoes_cliente'],
+        key='cliente_selecionado'
     )
 
     # Filtrar os dados de horas com base na data e nos filtros selecionados
-    dados_filtrados = dados_horas[(dados_horas['data'] >= start_date) & (dados_horas['data'] <= end_date)].copy()
+    # Com clientes selecionados, parte apenas das linhas desses clientes
+    if cliente_selecionado:
+        dados_base = dados_horas.take(linhas_dos_clientes(indice_pesquisa_clientes, cliente_selecionado))
+    else:
+        dados_base = dados_horas
+    dados_filtrados = dados_base[(dados_base['data'] >= start_date) & (dados_base['data'] <= end_date)].copy()
 
     if area_selecionada != 'Todas':
         dados_filtrados = dados_filtrados.loc[dados_filtrados['área'] == area_selecionada]
@@ -783,14 +1506,12 @@ if st.session_state['authenticated']:
         dados_filtrados = dados_filtrados.loc[dados_filtrados['executante'] == executante_selecionado]
     if tipo_hora_selecionado != 'Todos':
         dados_filtrados = dados_filtrados.loc[dados_filtrados['tipo_hora'] == tipo_hora_selecionado]
-    if cliente_selecionado:
-        dados_filtrados = dados_filtrados.loc[dados_filtrados['cliente'].isin(cliente_selecionado)]
-
-    dados_filtrados['vinculo_processo_servico'] = dados_filtrados['vinculo_processo_servico'].astype(str)
 
     # Filtrar os dados processados com base na data selecionada
+    # As tabelas mensais são datadas no fim do mês: o mês da data final entra inteiro
+    fim_mes_selecionado = end_date + pd.offsets.MonthEnd(0)
     dados_filtrados_processados = dados_processados[(dados_processados['data'] >= start_date) &
-                                                    (dados_processados['data'] <= end_date)]
+                                                    (dados_processados['data'] <= fim_mes_selecionado)]
 
     # ====================================================================
     # PAGE CONTENT
@@ -801,18 +1522,25 @@ if st.session_state['authenticated']:
         <h1 style="font-size:40px;">Dashboard de Horas Trabalhadas</h1>
         """, unsafe_allow_html=True)
 
+    # Métricas pelo índice diário; filtro por cliente ou área + executante somam as linhas filtradas
+    if cliente_selecionado or (area_selecionada != 'Todas' and executante_selecionado != 'Todos'):
+        totais_metricas = dados_filtrados[COLUNAS_METRICAS].astype(float).sum()
+        tipo_hora_agrupado = dados_filtrados.groupby('tipo_hora')['duracao'].sum()
+    else:
+        totais_metricas, tipo_hora_agrupado = metricas_periodo(indice_metricas, start_date, end_date,
+                                                               area_selecionada, executante_selecionado,
+                                                               tipo_hora_selecionado)
+
     # Primeira linha de métricas
     col1, col2, col3 = st.columns(3)
     with col1:
-        st.metric("Total de Horas", f"{dados_filtrados['duracao'].sum():.2f} horas")
+        st.metric("Total de Horas", f"{totais_metricas['duracao']:.2f} horas")
     with col2:
-        st.metric("Total de Cobrança", f"R$ {dados_filtrados['cobranca'].sum():,.2f}")
+        st.metric("Total de Cobrança", f"R$ {totais_metricas['cobranca']:,.2f}")
     with col3:
-        st.metric("Total de Custo", f"R$ {dados_filtrados['custo'].sum():,.2f}")
+        st.metric("Total de Custo", f"R$ {totais_metricas['custo']:,.2f}")
 
-    # Segunda linha de métricas
-    # Agrupando por 'tipo_hora' e somando as horas
-    tipo_hora_agrupado = dados_filtrados.groupby('tipo_hora')['duracao'].sum()
+    # Segunda linha de métricas - horas por 'tipo_hora'
 
     # Extraindo as métricas para cada tipo de hora
     metricas_tipo_hora = {
@@ -833,31 +1561,92 @@ if st.session_state['authenticated']:
     st.text("")
 
     # Gráficos
-    dados_processados = process_data(dados_horas, dados_pagamentos)
+    codigos_tipo_pasta, tipos_servico, quantidade_pastas = codificar_tipo_pasta(versao_dados, dados_horas)
+    if cliente_selecionado or area_selecionada != 'Todas' or executante_selecionado != 'Todos' or \
+            tipo_hora_selecionado != 'Todos':
+        contagem_tipo_pasta = contar_tipo_pasta_linhas(dados_filtrados, codigos_tipo_pasta, len(tipos_servico),
+                                                       quantidade_pastas)
+    else:
+        # Só o intervalo de datas filtra: os parciais diários respondem sem percorrer as linhas
+        contagem_tipo_pasta = contar_tipo_pasta_periodo(
+            parciais_tipo_pasta(versao_dados, dados_horas, codigos_tipo_pasta), start_date, end_date,
+            len(tipos_servico), quantidade_pastas)
+
+    # Cada gráfico retorna a figura e a tabela agregada que a originou (usada na exportação)
+    graficos = {
+        'Valores Pagos, Cobrança e Custo': plot_hours_vs_payments(dados_filtrados_processados),
+        'Diferença % Pago/Cobrança': plot_diff_paid_vs_billed(dados_filtrados_processados),
+        'Diferença % Pago/Custo': plot_diff_paid_vs_cost(dados_filtrados_processados),
+        'Margem de Lucro Bruta': plot_gross_margin(dados_filtrados_processados),
+        'Cobrança e Custo': plot_cobranca_vs_custo(dados_filtrados_processados),
+        'Horas por Área': plot_hours_by_area(dados_filtrados),
+        'Horas por Executante': plot_hours_by_executante(dados_filtrados),
+        'Evolução das Horas': plot_hours_over_time(dados_filtrados, compacto=modo_compacto),
+        'Top 10 Clientes': plot_hours_by_client(dados_filtrados),
+        'Horas por Tipo de Pasta': plot_hours_by_type(dados_filtrados),
+        'Horas / Cobrança / Custo por Tipo de Serviço': plot_hours_by_service_type(dados_filtrados),
+        'Média de Horas / Qtidade de Pasta': plot_avg_hours_per_service_by_folder(tipos_servico, *contagem_tipo_pasta)
+    }
 
-    st.plotly_chart(plot_hours_vs_payments(dados_filtrados_processados))
-    st.text("")
-    st.plotly_chart(plot_diff_paid_vs_billed(dados_filtrados_processados))
-    st.text("")
-    st.plotly_chart(plot_diff_paid_vs_cost(dados_filtrados_processados))
-    st.text("")
-    st.plotly_chart(plot_gross_margin(dados_filtrados_processados))
-    st.text("")
-    st.plotly_chart(plot_cobranca_vs_custo(dados_filtrados_processados))
-    st.text("")
-    st.plotly_chart(plot_hours_by_area(dados_filtrados))
-    st.text("")
-    st.plotly_chart(plot_hours_by_executante(dados_filtrados))
-    st.text("")
-    st.plotly_chart(plot_hours_over_time(dados_filtrados))
-    st.text("")
-    st.plotly_chart(plot_hours_by_client(dados_filtrados))
-    st.text("")
-    st.plotly_chart(plot_hours_by_type(dados_filtrados))
-    st.text("")
-    st.plotly_chart(plot_hours_by_service_type(dados_filtrados))
-    st.text("")
-    st.plotly_chart(plot_avg_hours_per_service_by_folder(dados_filtrados))
+    for nome, (fig, _) in graficos.items():
+        exibir_grafico(nome, fig)
+        st.text("")
+
+    # ====================================================================
+    # CONCILIAÇÃO POR CLIENTE
+    # ====================================================================
+
+    st.markdown("""
+        <h1 style="font-size:20px; text-align: center;">Conciliação Cobrança x Pagamento por Cliente</h1>
+        """, unsafe_allow_html=True)
+
+    defasagem_meses = st.number_input(
+        'Defasagem entre cobrança e pagamento (meses):',
+        min_value=0,
+        max_value=12,
+        value=1,
+        step=1
+    )
+
+    conciliacao, pagamentos_sem_cobranca = conciliar_clientes(versao_dados, int(defasagem_meses), meses_carregados,
+                                                              dados_horas, dados_pagamentos)
+
+    # Filtrar a conciliação com base na data e nos clientes selecionados
+    conciliacao_filtrada = conciliacao[(conciliacao['data'] >= start_date) &
+                                       (conciliacao['data'] <= fim_mes_selecionado)]
+    if cliente_selecionado:
+        conciliacao_filtrada = conciliacao_filtrada.loc[conciliacao_filtrada['cliente'].isin(cliente_selecionado)]
+
+    resumo_conciliacao = resumir_conciliacao(conciliacao_filtrada)
+
+    # Pagamentos sem cobrança com os mesmos filtros de data e cliente
+    pagamentos_sem_cobranca = pagamentos_sem_cobranca[(pagamentos_sem_cobranca['data_pag'] >= start_date) &
+                                                      (pagamentos_sem_cobranca['data_pag'] <= fim_mes_selecionado)]
+    if cliente_selecionado:
+        pagamentos_sem_cobranca = pagamentos_sem_cobranca.loc[
+            pagamentos_sem_cobranca['cliente'].isin(cliente_selecionado)]
+
+    col7, col8, col9 = st.columns(3)
+    with col7:
+        st.metric("Clientes com Saldo Negativo", f"{(resumo_conciliacao['Saldo'] < 0).sum()}")
+    with col8:
+        st.metric("Saldo Total (Pago - Cobrança)", f"R$ {resumo_conciliacao['Saldo'].sum():,.2f}")
+    with col9:
+        st.metric("Pagamentos sem Cobrança", f"R$ {pagamentos_sem_cobranca['valor_pag'].sum():,.2f}")
+
+    if not resumo_conciliacao.empty:
+        graficos['Saldo por Cliente'] = plot_saldo_por_cliente(resumo_conciliacao)
+        exibir_grafico('Saldo por Cliente', graficos['Saldo por Cliente'][0])
+    st.dataframe(resumo_conciliacao, hide_index=True)
+
+    # Detalhe mensal dos clientes selecionados (sem seleção, a tabela completa fica disponível na exportação)
+    detalhe_conciliacao = detalhar_conciliacao(conciliacao_filtrada)
+    if cliente_selecionado:
+        st.markdown("**Conciliação mensal dos clientes selecionados**")
+        st.dataframe(detalhe_conciliacao, hide_index=True,
+                     column_config={'Mês': st.column_config.DateColumn('Mês', format='MM/YYYY')})
+    else:
+        st.caption("Selecione clientes no filtro para ver a conciliação mês a mês.")
     st.text("")
 
     # Título do dataframe
@@ -868,5 +1657,54 @@ if st.session_state['authenticated']:
     # Exibir dados filtrados
     st.dataframe(dados_filtrados)
 
+    # ====================================================================
+    # EXPORTAÇÃO
+    # ====================================================================
+
+    col10, col11, col12 = st.columns(3)
+    with col10:
+        conteudo_exportacao = st.selectbox(
+            'Dados para exportar:',
+            options=['Dados filtrados', 'Conciliação por cliente', 'Conciliação mensal por cliente'] +
+                    list(graficos.keys())
+        )
+    with col11:
+        formato_exportacao = st.selectbox('Formato:', options=list(FORMATOS_EXPORTACAO.keys()))
+    with col12:
+        # O arquivo só é gerado quando solicitado, e não a cada interação com os filtros
+        if st.button('Gerar arquivo'):
+            if conteudo_exportacao == 'Dados filtrados':
+                origem_exportacao = dados_horas
+                blocos = blocos_por_indice(dados_horas, dados_filtrados.index)
+            else:
+                if conteudo_exportacao == 'Conciliação por cliente':
+                    origem_exportacao = resumo_conciliacao
+                elif conteudo_exportacao == 'Conciliação mensal por cliente':
+                    origem_exportacao = detalhe_conciliacao
+                else:
+                    origem_exportacao = graficos[conteudo_exportacao][1]
+                blocos = [origem_exportacao]
+
+            extensao, mime = FORMATOS_EXPORTACAO[formato_exportacao]
+            with st.spinner('Gerando arquivo...'):
+                if formato_exportacao == 'Parquet':
+                    arquivo_exportacao = exportar_parquet(blocos, esquema_arrow(origem_exportacao))
+                else:
+                    arquivo_exportacao = EXPORTADORES[formato_exportacao](blocos)
+            st.download_button(
+                'Baixar arquivo',
+                data=arquivo_exportacao,
+                file_name=f"{conteudo_exportacao.lower().replace(' ', '_').replace('/', '')}.{extensao}",
+                mime=mime
+            )
+
+    # Tamanho enviado por gráfico nesta execução
+    if medir_graficos:
+        with st.expander('Tamanho dos gráficos enviados'):
+            tamanhos = pd.DataFrame({'Gráfico': list(tamanhos_graficos.keys()),
+                                     'KB': [tamanho / 1024 for tamanho in tamanhos_graficos.values()]})
+            st.metric("Total Enviado", f"{tamanhos['KB'].sum():,.1f} KB")
+            st.dataframe(tamanhos.round(1), hide_index=True)
+
 else:
     st.info("Please log in to view the content.")
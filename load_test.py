@@ -0,0 +1,431 @@
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import msal
+import numpy as np
+import pandas as pd
+import psutil
+import requests
+import toml
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ClientState_pb2 import ClientState
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+from streamlit.web import cli as stcli
+from tornado.websocket import websocket_connect
+
+# pip install psutil (apenas para o teste de carga)
+# python load_test.py --sessoes 1 5 10 20
+# python load_test.py --sessoes 10 --planilha-horas horas.xlsx --planilha-pagamentos pagamentos.xlsx
+
+# Um único servidor 'streamlit run home.py' atende todas as sessões (conexões websocket, como navegadores);
+# o RSS informado é o desse processo servidor
+
+DIRETORIO_APP = os.path.dirname(os.path.abspath(__file__))
+TOKEN_FALSO = 'token-teste-carga'
+MICROSSEGUNDOS_DIA = 86_400 * 1_000_000
+ROTULOS_FILTROS = ['Selecione uma Área:', 'Selecione um Executante:', 'Selecione o Tipo de Hora:']
+ROTULO_SLIDER_DATAS = 'Selecione o intervalo de datas:'
+
+
+# ====================================================================
+# PLANILHAS DE EXEMPLO
+# ====================================================================
+
+def gerar_planilhas_exemplo(linhas, clientes, seed=0):
+    rng = np.random.default_rng(seed)
+    datas = pd.Timestamp('2021-01-01') + pd.to_timedelta(rng.integers(0, 3 * 365, linhas), unit='D')
+    areas = np.array(['Cível', 'Trabalhista', 'Tributário', 'Societário', 'Administrativo'])
+    executantes = np.array([f'Executante {numero:02d}' for numero in range(40)])
+    nomes_clientes = np.array([f'Cliente {numero:04d}' for numero in range(clientes)])
+    tipos = np.array([f'Serviço {numero:02d} - Consultoria e Acompanhamento' for numero in range(25)])
+
+    duracao = rng.gamma(2.0, 1.0, linhas).round(2)
+    horas = pd.DataFrame({
+        'data': datas,
+        'área': rng.choice(areas, linhas),
+        'executante': rng.choice(executantes, linhas),
+        'tipo_hora': rng.choice(['Serviço', 'Interno', 'Processo'], linhas, p=[0.5, 0.2, 0.3]),
+        'cliente': rng.choice(nomes_clientes, linhas),
+        'tipo': rng.choice(tipos, linhas),
+        'vinculo_processo_servico': rng.integers(100000, 100000 + linhas // 5, linhas),
+        'duracao': duracao,
+        'cobranca': (duracao * rng.uniform(200, 600, linhas)).round(2),
+        'custo': (duracao * rng.uniform(80, 250, linhas)).round(2)
+    })
+
+    mensal = horas.groupby(['cliente', horas['data'].dt.to_period('M')])['cobranca'].sum().reset_index()
+    pagamentos = pd.DataFrame({
+        'cliente': mensal['cliente'],
+        'data_pag': (mensal['data'] + 1).dt.to_timestamp() + pd.to_timedelta(rng.integers(0, 28, len(mensal)),
+                                                                              unit='D'),
+        'valor_pag': (mensal['cobranca'] * rng.uniform(0.7, 1.05, len(mensal))).round(2)
+    })
+
+    planilha_horas = io.BytesIO()
+    horas.to_excel(planilha_horas, sheet_name='horas_resolv', index=False)
+    planilha_pagamentos = io.BytesIO()
+    pagamentos.to_excel(planilha_pagamentos, index=False)
+    return planilha_horas.getvalue(), planilha_pagamentos.getvalue()
+
+
+# ====================================================================
+# SERVIDOR FALSO (TOKEN + GRAPH)
+# ====================================================================
+
+def criar_servidor_falso(arquivos):
+    class Handler(BaseHTTPRequestHandler):
+        def responder(self, status, corpo, tipo='application/json'):
+            self.send_response(status)
+            self.send_header('Content-Type', tipo)
+            self.send_header('Content-Length', str(len(corpo)))
+            self.end_headers()
+            self.wfile.write(corpo)
+
+        def do_POST(self):
+            # Endpoint de token no formato client credentials
+            if self.path.endswith('/oauth2/v2.0/token'):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                corpo = json.dumps({'access_token': TOKEN_FALSO, 'token_type': 'Bearer', 'expires_in': 3600})
+                self.responder(200, corpo.encode())
+            else:
+                self.responder(404, b'{}')
+
+        def do_GET(self):
+            # /v1.0/sites/{site}/drives/{drive}/items/{item}[/content]
+            partes = urlsplit(self.path).path.strip('/').split('/')
+            if self.headers.get('Authorization') != f'Bearer {TOKEN_FALSO}':
+                self.responder(401, b'{}')
+            elif len(partes) == 8 and partes[-1] == 'content' and partes[-2] in arquivos:
+                self.responder(200, arquivos[partes[-2]], 'application/octet-stream')
+            elif len(partes) == 7 and partes[-1] in arquivos:
+                etag = hashlib.md5(arquivos[partes[-1]]).hexdigest()
+                self.responder(200, json.dumps({'eTag': f'"{{{etag}}},1"'}).encode())
+            else:
+                self.responder(404, b'{}')
+
+        def log_message(self, formato, *args):
+            pass
+
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+
+class ClienteMsalFalso:
+    # Substitui o ConfidentialClientApplication, pedindo o token ao servidor falso
+    url_token = None
+
+    def __init__(self, client_id, authority=None, client_credential=None, **kwargs):
+        self.client_id = client_id
+        self.client_credential = client_credential
+
+    def acquire_token_for_client(self, scopes, **kwargs):
+        response = requests.post(self.url_token, data={
+            'grant_type': 'client_credentials',
+            'client_id': self.client_id,
+            'client_secret': self.client_credential,
+            'scope': ' '.join(scopes)
+        })
+        response.raise_for_status()
+        return response.json()
+
+
+# ====================================================================
+# SERVIDOR STREAMLIT
+# ====================================================================
+
+def porta_livre():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def preparar_diretorio_servidor(secrets):
+    # O servidor lê os secrets de .streamlit/secrets.toml no diretório de trabalho; o logo usa caminho relativo
+    diretorio = tempfile.mkdtemp(prefix='teste_carga_')
+    os.makedirs(os.path.join(diretorio, '.streamlit'))
+    with open(os.path.join(diretorio, '.streamlit', 'secrets.toml'), 'w', encoding='utf-8') as arquivo:
+        toml.dump(secrets, arquivo)
+    shutil.copytree(os.path.join(DIRETORIO_APP, 'images'), os.path.join(diretorio, 'images'))
+    return diretorio
+
+
+def iniciar_servidor_streamlit(diretorio, url_token, timeout):
+    porta = porta_livre()
+    processo = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--servidor', '--porta', str(porta),
+                                 '--url-token', url_token], cwd=diretorio)
+    limite = time.time() + timeout
+    while time.time() < limite:
+        if processo.poll() is not None:
+            raise RuntimeError('O servidor Streamlit terminou durante a inicialização')
+        try:
+            if requests.get(f'http://127.0.0.1:{porta}/_stcore/health', timeout=1).ok:
+                return processo, porta
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(0.5)
+    processo.terminate()
+    raise TimeoutError('O servidor Streamlit não respondeu a tempo')
+
+
+def executar_servidor(porta, url_token):
+    # Processo do servidor: o MSAL é trocado pelo cliente falso antes de o app ser executado
+    ClienteMsalFalso.url_token = url_token
+    msal.ConfidentialClientApplication = ClienteMsalFalso
+    sys.argv = ['streamlit', 'run', os.path.join(DIRETORIO_APP, 'home.py'),
+                '--server.port', str(porta),
+                '--server.address', '127.0.0.1',
+                '--server.headless', 'true',
+                '--server.fileWatcherType', 'none',
+                '--browser.gatherUsageStats', 'false']
+    sys.exit(stcli.main())
+
+
+class AmostradorRss(threading.Thread):
+    # Amostra o RSS do processo servidor enquanto as sessões de um nível rodam
+    def __init__(self, pid, intervalo=0.1):
+        super().__init__(daemon=True)
+        self.processo = psutil.Process(pid)
+        self.intervalo = intervalo
+        self.inicial = self.pico = self.rss()
+        self.parar = threading.Event()
+
+    def rss(self):
+        return self.processo.memory_info().rss / 1024 ** 2
+
+    def run(self):
+        while not self.parar.wait(self.intervalo):
+            self.pico = max(self.pico, self.rss())
+
+
+# ====================================================================
+# SESSÕES SIMULADAS
+# ====================================================================
+
+def montar_secrets(url_servidor):
+    return {
+        'sharepoint': {
+            'client_id': 'cliente-teste',
+            'client_secret': 'segredo-teste',
+            'tenant_id': 'tenant-teste',
+            'site_id': 'site-teste',
+            'drive_id': 'drive-teste',
+            'planilha_horas_id': 'horas',
+            'planilha_pagamentos_id': 'pagamentos',
+            'graph_url': f'{url_servidor}/v1.0'
+        },
+        'credentials': {'username': 'usuario', 'password': 'senha'}
+    }
+
+
+class SessaoNavegador:
+    # Faz o papel do navegador no websocket do Streamlit: envia BackMsg de rerun com o estado dos widgets e
+    # lê as ForwardMsg até o fim da execução do script
+    def __init__(self, porta, timeout):
+        self.url = f'ws://127.0.0.1:{porta}/_stcore/stream'
+        self.timeout = timeout
+        self.conexao = None
+        self.widgets = {}  # rótulo -> (tipo, elemento) da última execução
+        self.valores = {}  # rótulo -> valor escolhido pela sessão
+        self.mensagens = {}  # hash -> ForwardMsg; o servidor reenvia mensagens repetidas só pela referência
+        self.erros = 0
+
+    async def conectar(self):
+        self.conexao = await websocket_connect(self.url, subprotocols=['streamlit'], max_message_size=1024 ** 3)
+
+    def fechar(self):
+        if self.conexao is not None:
+            self.conexao.close()
+
+    def estado_widget(self, rotulo, valor):
+        tipo, elemento = self.widgets[rotulo]
+        estado = WidgetState(id=elemento.id)
+        if tipo == 'selectbox':
+            # O selectbox envia o índice; a opção escolhida pode ter sumido (executantes dependem da área)
+            if valor not in elemento.options:
+                return None
+            estado.int_value = list(elemento.options).index(valor)
+        elif tipo == 'slider':
+            estado.double_array_value.data.extend(valor)
+        elif tipo == 'button':
+            estado.trigger_value = True
+        else:
+            estado.string_value = valor
+        return estado
+
+    async def executar(self, botao=None):
+        estado_cliente = ClientState()
+        valores = dict(self.valores, **({botao: True} if botao else {}))
+        for rotulo, valor in valores.items():
+            estado = self.estado_widget(rotulo, valor) if rotulo in self.widgets else None
+            if estado is not None:
+                estado_cliente.widget_states.widgets.append(estado)
+        mensagem = BackMsg()
+        mensagem.rerun_script.CopyFrom(estado_cliente)
+
+        inicio = time.perf_counter()
+        await self.conexao.write_message(mensagem.SerializeToString(), binary=True)
+        await asyncio.wait_for(self.aguardar_fim_execucao(), self.timeout)
+        return time.perf_counter() - inicio
+
+    async def aguardar_fim_execucao(self):
+        while True:
+            dados = await self.conexao.read_message()
+            if dados is None:
+                raise ConnectionError('O servidor fechou a conexão')
+            mensagem = ForwardMsg.FromString(dados)
+            if mensagem.WhichOneof('type') == 'ref_hash':
+                mensagem = self.mensagens.get(mensagem.ref_hash, mensagem)
+            elif mensagem.metadata.cacheable:
+                self.mensagens[mensagem.hash] = mensagem
+
+            tipo = mensagem.WhichOneof('type')
+            if tipo == 'new_session':
+                # Início de uma execução (inclusive a disparada pelo rerun do login)
+                self.widgets = {}
+            elif tipo == 'delta' and mensagem.delta.WhichOneof('type') == 'new_element':
+                elemento = mensagem.delta.new_element
+                tipo_elemento = elemento.WhichOneof('type')
+                if tipo_elemento == 'exception':
+                    self.erros += 1
+                elif tipo_elemento in ('text_input', 'button', 'selectbox', 'slider'):
+                    widget = getattr(elemento, tipo_elemento)
+                    self.widgets[widget.label] = (tipo_elemento, widget)
+            elif tipo == 'script_finished':
+                if mensagem.script_finished == ForwardMsg.FINISHED_WITH_COMPILE_ERROR:
+                    self.erros += 1
+                    return
+                if mensagem.script_finished == ForwardMsg.FINISHED_SUCCESSFULLY:
+                    return
+
+
+async def simular_sessao(porta, credenciais, passos_slider, trocas_filtro, timeout, seed):
+    rng = random.Random(seed)
+    latencias = []
+    sessao = SessaoNavegador(porta, timeout)
+    try:
+        await sessao.conectar()
+
+        # Login
+        latencias.append(await sessao.executar())
+        sessao.valores['Username'] = credenciais['username']
+        sessao.valores['Password'] = credenciais['password']
+        latencias.append(await sessao.executar(botao='Login'))
+        if ROTULO_SLIDER_DATAS not in sessao.widgets:
+            return latencias, sessao.erros + 1
+
+        # Troca de filtros
+        for _ in range(trocas_filtro):
+            rotulo = rng.choice(ROTULOS_FILTROS)
+            _, selectbox = sessao.widgets[rotulo]
+            sessao.valores[rotulo] = rng.choice(list(selectbox.options))
+            latencias.append(await sessao.executar())
+
+        # Arrasto do slider de datas: o início avança a cada passo (valores em microssegundos)
+        _, slider = sessao.widgets[ROTULO_SLIDER_DATAS]
+        inicio, fim = slider.min, slider.max
+        passo = (fim - inicio) / (2 * max(passos_slider, 1))
+        for numero in range(1, passos_slider + 1):
+            novo_inicio = inicio + (passo * numero) // MICROSSEGUNDOS_DIA * MICROSSEGUNDOS_DIA
+            sessao.valores[ROTULO_SLIDER_DATAS] = [novo_inicio, fim]
+            latencias.append(await sessao.executar())
+        return latencias, sessao.erros
+    except (asyncio.TimeoutError, ConnectionError, OSError):
+        return latencias, sessao.erros + 1
+    finally:
+        sessao.fechar()
+
+
+async def executar_sessoes(sessoes, porta, credenciais, args):
+    # Todas as sessões do nível começam juntas no mesmo servidor
+    return await asyncio.gather(*[simular_sessao(porta, credenciais, args.passos_slider, args.trocas_filtro,
+                                                 args.timeout, args.seed + numero) for numero in range(sessoes)])
+
+
+def executar_nivel(sessoes, processo, porta, credenciais, args):
+    amostrador = AmostradorRss(processo.pid)
+    amostrador.start()
+    inicio = time.perf_counter()
+    resultados = asyncio.run(executar_sessoes(sessoes, porta, credenciais, args))
+    duracao_total = time.perf_counter() - inicio
+    amostrador.parar.set()
+    amostrador.join()
+
+    latencias = np.array([latencia for resultado in resultados for latencia in resultado[0]])
+    erros = sum(resultado[1] for resultado in resultados)
+    p50, p95, p99 = np.percentile(latencias, [50, 95, 99]) if len(latencias) else (0, 0, 0)
+    return {
+        'sessoes': sessoes,
+        'reruns': len(latencias),
+        'erros': erros,
+        'p50_s': round(p50, 3),
+        'p95_s': round(p95, 3),
+        'p99_s': round(p99, 3),
+        'reruns_por_s': round(len(latencias) / duracao_total, 2),
+        'rss_servidor_inicio_mb': round(amostrador.inicial, 1),
+        'rss_servidor_pico_mb': round(amostrador.pico, 1),
+        'rss_servidor_fim_mb': round(amostrador.rss(), 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Teste de carga do dashboard com sessões simuladas.')
+    parser.add_argument('--sessoes', type=int, nargs='+', default=[1, 5, 10, 20])
+    parser.add_argument('--passos-slider', type=int, default=10)
+    parser.add_argument('--trocas-filtro', type=int, default=5)
+    parser.add_argument('--linhas', type=int, default=50000)
+    parser.add_argument('--clientes', type=int, default=2000)
+    parser.add_argument('--planilha-horas')
+    parser.add_argument('--planilha-pagamentos')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    # Uso interno: o próprio script é o processo do servidor Streamlit
+    parser.add_argument('--servidor', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--porta', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--url-token', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.servidor:
+        executar_servidor(args.porta, args.url_token)
+
+    if args.planilha_horas and args.planilha_pagamentos:
+        with open(args.planilha_horas, 'rb') as arquivo_horas, open(args.planilha_pagamentos, 'rb') as arquivo_pag:
+            planilha_horas, planilha_pagamentos = arquivo_horas.read(), arquivo_pag.read()
+    else:
+        planilha_horas, planilha_pagamentos = gerar_planilhas_exemplo(args.linhas, args.clientes, args.seed)
+
+    servidor = criar_servidor_falso({'horas': planilha_horas, 'pagamentos': planilha_pagamentos})
+    url_servidor = f'http://127.0.0.1:{servidor.server_address[1]}'
+    url_token = f'{url_servidor}/tenant-teste/oauth2/v2.0/token'
+    secrets = montar_secrets(url_servidor)
+
+    # Um único servidor para todos os níveis: o RSS mostra o crescimento conforme as sessões aumentam
+    diretorio = preparar_diretorio_servidor(secrets)
+    processo, porta = iniciar_servidor_streamlit(diretorio, url_token, args.timeout)
+    try:
+        relatorio = pd.DataFrame([executar_nivel(sessoes, processo, porta, secrets['credentials'], args)
+                                  for sessoes in args.sessoes])
+        print(relatorio.to_string(index=False))
+    finally:
+        processo.terminate()
+        processo.wait()
+        shutil.rmtree(diretorio, ignore_errors=True)
+        servidor.shutdown()
+
+if __name__ == '__main__':
+    main()